@@ -1,5 +1,9 @@
 import os
+import base64
+import functools
 import json
+import re
+import queue
 import time
 import threading
 import tempfile
@@ -7,10 +11,42 @@ import shutil
 from dataclasses import dataclass, asdict
 from typing import Dict, List, Optional, Tuple
 
+# BLAS thread pinning has to happen before numpy loads its backend. One knob
+# covers OpenBLAS/MKL/OMP; the default of 2 avoids oversubscription when
+# several gunicorn workers each run their own GEMMs. For the single-worker
+# micro-batching setup, set BLAS_THREADS to the core count (see wsgi.py).
+for _var in ("OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+             "OMP_NUM_THREADS", "NUMEXPR_NUM_THREADS"):
+    os.environ.setdefault(_var, os.getenv("BLAS_THREADS", "2"))
+
 import numpy as np
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 
+try:
+    import orjson  # optional: serializes numpy arrays natively, ~5x stdlib json
+except ImportError:
+    orjson = None
+
+try:
+    import simsimd  # optional SIMD cosine/dot kernels; NumPy path is the fallback
+except ImportError:
+    simsimd = None
+
+try:
+    import faiss  # optional: indexed search once the refs matrix grows large
+except ImportError:
+    faiss = None
+
+try:
+    import msgpack  # optional: binary /api/sort responses for non-UI clients
+except ImportError:
+    msgpack = None
+
+# only index once exhaustive scoring stops being the faster option
+FAISS_MIN_REFS = int(os.getenv("FAISS_MIN_REFS", "10000"))
+FAISS_TOPK = 64  # candidate rows fetched per query from the index
+
 # -----------------------
 # Config
 # -----------------------
@@ -36,10 +72,26 @@ def require_admin():
 # Storage for refs
 # -----------------------
 REFS_META_PATH = os.path.join(DATA_DIR, "refs_meta.json")
-REFS_NPZ_PATH  = os.path.join(DATA_DIR, "refs_store.npz")
+REFS_NPZ_PATH  = os.path.join(DATA_DIR, "refs_store.npz")  # legacy monolithic archive
+REFS_DIR       = os.path.join(DATA_DIR, "refs")            # one .npy per person, mmap-able
+
+_UNSAFE_CHARS = re.compile(r"[^A-Za-z0-9_-]")
 
+@functools.lru_cache(maxsize=10000)
 def _safe_key(name: str) -> str:
-    return "".join(ch if ch.isalnum() or ch in ("_", "-") else "_" for ch in name)
+    # C-level regex sub instead of a per-character Python loop; save() calls
+    # this for every person on every persist, so cache the results too
+    return _UNSAFE_CHARS.sub("_", name)
+
+# Unit-norm embeddings have |x| <= 1, so a single global scale of 127 maps
+# them onto int8 with negligible cosine error and 4x less storage/bandwidth.
+I8_SCALE = 127.0
+
+def quantize_i8(v: np.ndarray) -> np.ndarray:
+    return np.round(np.clip(v, -1.0, 1.0) * I8_SCALE).astype(np.int8)
+
+def dequantize_i8(q: np.ndarray) -> np.ndarray:
+    return q.astype(np.float32) / I8_SCALE
 
 @dataclass
 class PersonStats:
@@ -56,18 +108,108 @@ class RefsStore:
     """
     def __init__(self):
         self.persons: Dict[str, np.ndarray] = {}
+        # int8 mirror of persons (same rows, quantized) used by the SIMD
+        # int8 scoring path and as the on-disk format
+        self.persons_i8: Dict[str, np.ndarray] = {}
+        # pid -> {"f32": (cap, d), "i8": (cap, d), "n": rows used}; capacity
+        # doubles on overflow so streamed merges copy O(N) bytes, not O(N^2)
+        self._bufs: Dict[str, dict] = {}
         self.dims: Optional[int] = None
-        self._lock = threading.Lock()
+        # pid -> (n_vectors, mu, sigma); recomputed only when the row count changes
+        self._stats_cache: Dict[str, Tuple[int, float, float]] = {}
+        # concatenated scoring matrix, rebuilt on mutation instead of per request
+        self.pids: List[str] = []
+        self.R: Optional[np.ndarray] = None          # (Ntot, d) float32
+        self.R_i8: Optional[np.ndarray] = None       # (Ntot, d) int8 mirror
+        self.owner: Optional[np.ndarray] = None      # (Ntot,) int32 row -> person index
+        self.offsets: Optional[np.ndarray] = None    # (P+1,) row offsets per person
+        self.mu: Optional[np.ndarray] = None         # (P,) float32
+        self.sigma: Optional[np.ndarray] = None      # (P,) float32
+        self.index = None                            # faiss index over R when large
+        self._lock = threading.RLock()
+
+    def _rebuild_matrix(self):
+        # must be called with self._lock held
+        if not self.persons:
+            self.pids = []
+            self.R = self.R_i8 = self.owner = None
+            self.offsets = self.mu = self.sigma = None
+            self.index = None
+            return
+        pids = list(self.persons.keys())
+        counts = [self.persons[p].shape[0] for p in pids]
+        self.pids = pids
+        self.R = np.vstack([self.persons[p] for p in pids])
+        self.R_i8 = np.vstack([self.persons_i8[p] for p in pids])
+        self.offsets = np.cumsum([0] + counts)
+        self.owner = np.repeat(np.arange(len(pids), dtype=np.int32), counts)
+        stats = [self._person_stats(p, self.persons[p]) for p in pids]
+        self.mu = np.array([s[0] for s in stats], dtype=np.float32)
+        self.sigma = np.array([s[1] for s in stats], dtype=np.float32)
+        if faiss is not None and self.R.shape[0] >= FAISS_MIN_REFS:
+            # rows are already unit, so inner product == cosine
+            index = faiss.IndexFlatIP(self.R.shape[1])
+            index.add(np.ascontiguousarray(self.R))
+            self.index = index
+        else:
+            self.index = None
+
+    def matrix_snapshot(self):
+        """Consistent view for scoring: (pids, R, R_i8, owner, offsets, mu, sigma, index)."""
+        with self._lock:
+            return (self.pids, self.R, self.R_i8, self.owner,
+                    self.offsets, self.mu, self.sigma, self.index)
 
     def clear(self):
         with self._lock:
             self.persons.clear()
+            self.persons_i8.clear()
+            self._bufs.clear()
+            self._stats_cache.clear()
             self.dims = None
+            self._rebuild_matrix()
+
+    def _append_rows(self, person_id: str, rows: np.ndarray):
+        # must be called with self._lock held
+        k, d = rows.shape
+        slot = self._bufs.get(person_id)
+        if slot is None:
+            # seed from any rows loaded from disk (one-time copy)
+            existing = self.persons.get(person_id)
+            base = 0 if existing is None else existing.shape[0]
+            cap = max(base + k, 8)
+            slot = {"f32": np.empty((cap, d), np.float32),
+                    "i8": np.empty((cap, d), np.int8),
+                    "n": base}
+            if base:
+                slot["f32"][:base] = existing
+                slot["i8"][:base] = self.persons_i8[person_id]
+            self._bufs[person_id] = slot
+        n = slot["n"]
+        if n + k > slot["f32"].shape[0]:
+            cap = max(slot["f32"].shape[0] * 2, n + k)
+            for key, dt in (("f32", np.float32), ("i8", np.int8)):
+                grown = np.empty((cap, d), dt)
+                grown[:n] = slot[key][:n]
+                slot[key] = grown
+        slot["f32"][n:n + k] = rows
+        slot["i8"][n:n + k] = quantize_i8(rows)
+        slot["n"] = n + k
+        # expose trimmed views; every other code path keeps reading persons[pid]
+        self.persons[person_id] = slot["f32"][:slot["n"]]
+        self.persons_i8[person_id] = slot["i8"][:slot["n"]]
+
+    def rebuild_matrix(self):
+        with self._lock:
+            self._rebuild_matrix()
 
-    def add_person_vectors(self, person_id: str, vectors: np.ndarray, mode: str = "merge"):
+    def add_person_vectors(self, person_id: str, vectors: np.ndarray, mode: str = "merge",
+                           rebuild: bool = True):
         """
         vectors: np.ndarray (n, d), unit rows. if dims unset, set from first add.
         mode: 'merge' or 'replace'
+        rebuild: pass False when adding many persons in a loop, then call
+        rebuild_matrix() once at the end.
         """
         if vectors.ndim != 2:
             raise ValueError("vectors must be 2D (n, d)")
@@ -79,19 +221,33 @@ class RefsStore:
         elif self.dims != d:
             raise ValueError(f"dimension mismatch: store={self.dims}, incoming={d}")
         with self._lock:
-            if mode == "replace" or person_id not in self.persons:
-                self.persons[person_id] = vectors.astype(np.float32, copy=False)
-            else:
-                if self.persons[person_id].size == 0:
-                    self.persons[person_id] = vectors.astype(np.float32, copy=False)
-                else:
-                    self.persons[person_id] = np.vstack([self.persons[person_id], vectors]).astype(np.float32, copy=False)
+            if mode == "replace":
+                self._bufs.pop(person_id, None)
+                self.persons.pop(person_id, None)
+                self.persons_i8.pop(person_id, None)
+                # the row count alone can't tell old rows from new ones:
+                # re-registering the same folder yields the same n, so the
+                # cache must be dropped explicitly or stale (mu, sigma)
+                # would keep driving the adaptive thresholds
+                self._stats_cache.pop(person_id, None)
+            self._append_rows(person_id, vectors.astype(np.float32, copy=False))
+            if rebuild:
+                self._rebuild_matrix()
+
+    def _person_stats(self, pid: str, arr: np.ndarray) -> Tuple[float, float]:
+        # must be called with self._lock held
+        cached = self._stats_cache.get(pid)
+        if cached is not None and cached[0] == arr.shape[0]:
+            return cached[1], cached[2]
+        mu, sig = pairwise_stats(arr)
+        self._stats_cache[pid] = (arr.shape[0], mu, sig)
+        return mu, sig
 
     def list_people(self) -> List[PersonStats]:
         out = []
         with self._lock:
             for pid, arr in self.persons.items():
-                mu, sig = pairwise_stats(arr)
+                mu, sig = self._person_stats(pid, arr)
                 out.append(PersonStats(
                     person_id=pid,
                     n_vectors=arr.shape[0],
@@ -103,21 +259,27 @@ class RefsStore:
 
     def save(self):
         with self._lock:
-            npz_dict = {}
-            meta = {"dims": self.dims, "persons": []}
+            os.makedirs(REFS_DIR, exist_ok=True)
+            meta = {"dims": self.dims, "quant": "int8", "persons": []}
+            keep = set()
             for pid, arr in self.persons.items():
                 key = _safe_key(pid)
-                npz_dict[key] = arr.astype(np.float32, copy=False)
-                meta["persons"].append({"person_id": pid, "key": key, "n": int(arr.shape[0])})
-
-            # write NPZ atomically
-            with tempfile.NamedTemporaryFile("wb", delete=False, dir=DATA_DIR, suffix=".npz") as tf:
-                if npz_dict:
-                    np.savez_compressed(tf, **npz_dict)
-                else:
-                    np.savez_compressed(tf, _empty=np.array([], dtype=np.float32))
-                tmp_npz = tf.name
-            shutil.move(tmp_npz, REFS_NPZ_PATH)
+                fname = f"{key}.npy"
+                # one uncompressed .npy per person, written atomically; no
+                # deflate on load and each file can be memory-mapped
+                with tempfile.NamedTemporaryFile("wb", delete=False, dir=REFS_DIR, suffix=".tmp") as tf:
+                    np.save(tf, self.persons_i8.get(pid, quantize_i8(arr)))
+                    tmp_npy = tf.name
+                shutil.move(tmp_npy, os.path.join(REFS_DIR, fname))
+                keep.add(fname)
+                mu, sig = self._person_stats(pid, arr)
+                meta["persons"].append({"person_id": pid, "key": key, "file": fname,
+                                        "n": int(arr.shape[0]), "mu": mu, "sigma": sig})
+
+            # drop files of persons that no longer exist
+            for name in os.listdir(REFS_DIR):
+                if name.endswith(".npy") and name not in keep:
+                    os.remove(os.path.join(REFS_DIR, name))
 
             # write JSON atomically
             with tempfile.NamedTemporaryFile("w", encoding="utf-8", delete=False, dir=DATA_DIR, suffix=".json") as tf:
@@ -125,25 +287,65 @@ class RefsStore:
                 tmp_json = tf.name
             shutil.move(tmp_json, REFS_META_PATH)
 
+            # the legacy monolithic NPZ is superseded by the per-person files
+            if os.path.exists(REFS_NPZ_PATH):
+                os.remove(REFS_NPZ_PATH)
+
     def load(self):
         self.clear()
-        if not os.path.exists(REFS_META_PATH) or not os.path.exists(REFS_NPZ_PATH):
+        if not os.path.exists(REFS_META_PATH):
             return
         try:
             with open(REFS_META_PATH, "r", encoding="utf-8") as f:
                 meta = json.load(f)
             dims = meta.get("dims")
             persons = {}
-            with np.load(REFS_NPZ_PATH, allow_pickle=False) as npz:
-                for p in meta.get("persons", []):
+            persons_i8 = {}
+            entries = meta.get("persons", [])
+            if any("file" in p for p in entries):
+                for p in entries:
                     pid = p.get("person_id")
-                    key = p.get("key")
-                    if not pid or not key or key not in npz:
+                    fname = p.get("file")
+                    if not pid or not fname:
+                        continue
+                    path = os.path.join(REFS_DIR, fname)
+                    if not os.path.exists(path):
                         continue
-                    arr = npz[key]
-                    persons[pid] = arr
+                    # zero-copy view of the file; pages are faulted in on demand
+                    arr = np.load(path, mmap_mode="r", allow_pickle=False)
+                    if arr.dtype == np.int8:
+                        persons_i8[pid] = arr
+                        persons[pid] = dequantize_i8(arr)
+                    else:
+                        persons[pid] = np.asarray(arr, dtype=np.float32)
+                        persons_i8[pid] = quantize_i8(persons[pid])
+            elif os.path.exists(REFS_NPZ_PATH):
+                # legacy monolithic archive
+                with np.load(REFS_NPZ_PATH, allow_pickle=False) as npz:
+                    for p in entries:
+                        pid = p.get("person_id")
+                        key = p.get("key")
+                        if not pid or not key or key not in npz:
+                            continue
+                        arr = npz[key]
+                        if arr.dtype == np.int8:
+                            persons_i8[pid] = arr
+                            persons[pid] = dequantize_i8(arr)
+                        else:
+                            persons[pid] = arr.astype(np.float32, copy=False)
+                            persons_i8[pid] = quantize_i8(persons[pid])
             self.persons = persons
+            self.persons_i8 = persons_i8
             self.dims = dims
+            # seed the stats cache from persisted (mu, sigma) so the first
+            # list_people/sort after startup skips the pairwise recompute
+            for p in entries:
+                pid = p.get("person_id")
+                if pid in persons and "mu" in p and "sigma" in p:
+                    self._stats_cache[pid] = (persons[pid].shape[0],
+                                              float(p["mu"]), float(p["sigma"]))
+            with self._lock:
+                self._rebuild_matrix()
         except Exception as e:
             print(f"[WARN] Failed to load refs: {e}", flush=True)
             self.clear()
@@ -152,9 +354,11 @@ class RefsStore:
 # Similarity + thresholds
 # -----------------------
 def l2norm(v: np.ndarray) -> np.ndarray:
-    # Normalize rows to unit length
+    # Normalize rows to unit length. einsum does one fused squared-sum pass
+    # and skips np.linalg.norm's dispatch/validation overhead.
     eps = 1e-12
-    norms = np.linalg.norm(v, axis=1, keepdims=True) + eps
+    v = np.ascontiguousarray(v, dtype=np.float32)
+    norms = np.sqrt(np.einsum("ij,ij->i", v, v))[:, None] + eps
     return v / norms
 
 def pairwise_stats(vectors: np.ndarray) -> Tuple[float, float]:
@@ -166,15 +370,10 @@ def pairwise_stats(vectors: np.ndarray) -> Tuple[float, float]:
     if n < 2:
         return 0.90, 0.05
     V = l2norm(vectors.astype(np.float32, copy=False))
-    sims = []
-    for i in range(n):
-        s = np.dot(V[i+1:], V[i])
-        if s.size:
-            sims.extend(s.tolist())
-    if not sims:
-        return 0.90, 0.05
-    sims_np = np.array(sims, dtype=np.float32)
-    return float(sims_np.mean()), float(sims_np.std(ddof=1) if sims_np.size > 1 else 0.05)
+    # one Gram matrix instead of n tiny matvecs + Python list building
+    G = V @ V.T
+    sims = G[np.triu_indices(n, k=1)]
+    return float(sims.mean()), float(sims.std(ddof=1) if sims.size > 1 else 0.05)
 
 def best_score_against_person(vec_u: np.ndarray, refs_u: np.ndarray) -> float:
     """
@@ -184,7 +383,13 @@ def best_score_against_person(vec_u: np.ndarray, refs_u: np.ndarray) -> float:
     """
     if refs_u.size == 0:
         return -1.0
-    sims = refs_u @ vec_u  # (n,)
+    if simsimd is not None:
+        # refs are unit rows, so 1 - cosine distance == dot product
+        dists = np.asarray(simsimd.cdist(refs_u, vec_u[None, :], metric="cosine"),
+                           dtype=np.float32).ravel()
+        sims = 1.0 - dists
+    else:
+        sims = refs_u @ vec_u  # (n,)
     return float(np.clip(np.max(sims), -1.0, 1.0))
 
 def compute_threshold(global_pct: int, adaptive_on: bool, mu: float, sigma: float, adaptive_k: float) -> float:
@@ -193,6 +398,171 @@ def compute_threshold(global_pct: int, adaptive_on: bool, mu: float, sigma: floa
         return g
     return max(g, mu - adaptive_k * sigma)
 
+def _score_matrix(R: np.ndarray, R_i8: np.ndarray, Q: np.ndarray) -> np.ndarray:
+    """
+    Score unit query rows Q (F, d) against the concatenated refs.
+    Returns S of shape (Ntot, F).
+    """
+    if simsimd is not None:
+        # int8 cosine uses the VNNI/dot-product instructions where the CPU
+        # has them; both sides are quantized with the same global scale
+        dists = np.asarray(simsimd.cdist(R_i8, quantize_i8(Q), metric="cosine"),
+                           dtype=np.float32)
+        return 1.0 - dists
+    return R @ Q.T
+
+def _person_scores(R, R_i8, owner, offsets, index, Q) -> np.ndarray:
+    """
+    Max-of-refs score per (person, face): returns (P, F) float32.
+    Uses the faiss index over candidate rows when the refs matrix is large
+    enough to have one; otherwise exhaustive scoring + segmented max.
+    """
+    n_persons = offsets.shape[0] - 1
+    if index is not None:
+        k = min(FAISS_TOPK, index.ntotal)
+        D, I = index.search(np.ascontiguousarray(Q, dtype=np.float32), k)
+        # persons outside the top candidates keep a floor score of -1
+        per_person = np.full((n_persons, Q.shape[0]), -1.0, dtype=np.float32)
+        for j in range(Q.shape[0]):
+            np.maximum.at(per_person[:, j], owner[I[j]], D[j].astype(np.float32))
+        return per_person
+    S = _score_matrix(R, R_i8, Q)
+    return np.maximum.reduceat(S, offsets[:-1], axis=0)
+
+# -----------------------
+# Request micro-batching
+# -----------------------
+class _SortJob:
+    __slots__ = ("Q", "event", "result", "error")
+
+    def __init__(self, Q: np.ndarray):
+        self.Q = Q
+        self.event = threading.Event()
+        self.result = None
+        self.error: Optional[str] = None
+
+class SortBatcher:
+    """
+    Coalesces concurrent /api/sort scoring calls arriving within a small
+    window into one GEMM against the refs matrix, then fans the score
+    columns back to the waiting requests. Small per-image requests would
+    otherwise each pay full dispatch overhead for a tiny matmul.
+    """
+    def __init__(self, window_s: float):
+        self.window = window_s
+        self._queue: "queue.Queue[_SortJob]" = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True, name="sort-batcher")
+        self._worker.start()
+
+    def score(self, Q: np.ndarray):
+        """Blocks until scored; returns (pids, mu, sigma, per_person_cols) or None if no refs."""
+        job = _SortJob(Q)
+        self._queue.put(job)
+        job.event.wait()
+        if job.error:
+            raise RuntimeError(job.error)
+        return job.result
+
+    def _run(self):
+        while True:
+            jobs = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    jobs.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._process(jobs)
+
+    def _process(self, jobs: List[_SortJob]):
+        try:
+            pids, R, R_i8, owner, offsets, mu, sigma, index = store.matrix_snapshot()
+            if R is None:
+                for job in jobs:
+                    job.result = None
+                return
+            Q = jobs[0].Q if len(jobs) == 1 else np.vstack([j.Q for j in jobs])
+            per_person = _person_scores(R, R_i8, owner, offsets, index, Q)
+            col = 0
+            for job in jobs:
+                f = job.Q.shape[0]
+                job.result = (pids, mu, sigma, per_person[:, col:col + f])
+                col += f
+        except Exception as e:
+            for job in jobs:
+                job.error = str(e)
+        finally:
+            for job in jobs:
+                job.event.set()
+
+# -----------------------
+# Payload parsing
+# -----------------------
+_B64_DTYPES = {"f4": np.float32, "f2": np.float16, "i1": np.int8}
+
+def _get_json(req) -> Optional[dict]:
+    """Parse the request body, via orjson when available (2-5x stdlib)."""
+    if orjson is not None:
+        try:
+            return orjson.loads(req.get_data(cache=False))
+        except Exception:
+            return None
+    return req.get_json(silent=True)
+
+def _vectors_from_payload(obj: dict) -> Optional[np.ndarray]:
+    """
+    Extract a (n, d) float32 array from a payload dict. Accepts either
+    "vectors" (nested JSON lists) or "vectors_b64" + "dims" (base64-encoded
+    row-major bytes, dtype "f4"/"f2"/"i1") which skips per-float parsing.
+    Returns None when the payload is malformed.
+    """
+    b64 = obj.get("vectors_b64")
+    if b64:
+        try:
+            dims = int(obj.get("dims") or 0)
+            dtype = _B64_DTYPES.get(obj.get("dtype", "f4"))
+            if dims <= 0 or dtype is None:
+                return None
+            raw = np.frombuffer(base64.b64decode(b64), dtype=dtype)
+        except Exception:
+            return None
+        if raw.size == 0 or raw.size % dims:
+            return None
+        arr = raw.reshape(-1, dims)
+        if dtype is np.int8:
+            return dequantize_i8(arr)
+        return arr.astype(np.float32, copy=False)
+    vectors = obj.get("vectors")
+    if not isinstance(vectors, list) or not vectors:
+        return None
+    try:
+        arr = np.asarray(vectors, dtype=np.float32)
+    except (TypeError, ValueError):
+        return None
+    return arr if arr.ndim == 2 else None
+
+def _vector_from_face(f: dict) -> np.ndarray:
+    """Single query vector from a face dict: "vector" list or "vector_b64"."""
+    b64 = f.get("vector_b64")
+    if b64:
+        try:
+            dtype = _B64_DTYPES.get(f.get("dtype", "f4"))
+            if dtype is None:
+                return np.array([], dtype=np.float32)
+            raw = np.frombuffer(base64.b64decode(b64), dtype=dtype)
+        except Exception:
+            return np.array([], dtype=np.float32)
+        if dtype is np.int8:
+            return dequantize_i8(raw)
+        return raw.astype(np.float32, copy=False)
+    try:
+        return np.asarray(f.get("vector", []), dtype=np.float32)
+    except (TypeError, ValueError):
+        return np.array([], dtype=np.float32)
+
 # -----------------------
 # Flask app
 # -----------------------
@@ -203,6 +573,10 @@ CORS(app, resources={r"/api/*": {"origins": "*"}})
 store = RefsStore()
 store.load()
 
+# coalescing window for concurrent sort requests; 0 disables batching
+SORT_BATCH_WINDOW_MS = float(os.getenv("SORT_BATCH_WINDOW_MS", "5"))
+SORT_BATCHER = SortBatcher(SORT_BATCH_WINDOW_MS / 1000.0) if SORT_BATCH_WINDOW_MS > 0 else None
+
 @app.route("/")
 def index():
     return app.send_static_file("index.html")  # index.html is served from /static
@@ -225,19 +599,16 @@ def health():
 def refs_register():
     if not is_admin(request):
         return require_admin()
-    payload = request.get_json(silent=True)
+    payload = _get_json(request)
     if not payload:
         return jsonify({"status":"error","message":"JSON body required"}), 400
 
     person_id = (payload.get("person_id") or "").strip()
-    vectors = payload.get("vectors", [])
     mode = payload.get("mode", "merge")
-    if not person_id or not isinstance(vectors, list) or len(vectors) == 0:
-        return jsonify({"status":"error","message":"person_id and non-empty vectors[] required"}), 400
+    arr = _vectors_from_payload(payload)
+    if not person_id or arr is None:
+        return jsonify({"status":"error","message":"person_id and non-empty vectors[] (or vectors_b64 + dims) required"}), 400
 
-    arr = np.array(vectors, dtype=np.float32)
-    if arr.ndim != 2:
-        return jsonify({"status":"error","message":"vectors must be 2D: [[...],[...]]"}), 400
     if not np.isfinite(arr).all():
         return jsonify({"status":"error","message":"vectors contain NaN/Inf"}), 400
     if arr.shape[1] > 2048:
@@ -258,7 +629,7 @@ def refs_register():
 def refs_register_batch():
     if not is_admin(request):
         return require_admin()
-    payload = request.get_json(silent=True)
+    payload = _get_json(request)
     if not payload:
         return jsonify({"status":"error","message":"JSON body required"}), 400
 
@@ -267,22 +638,41 @@ def refs_register_batch():
     if not isinstance(persons, list) or not persons:
         return jsonify({"status":"error","message":"persons[] required"}), 400
 
+    decoded = []
+    for p in persons:
+        pid = (p.get("person_id") or "").strip()
+        arr = _vectors_from_payload(p)
+        if not pid or arr is None or arr.shape[1] > 2048:
+            continue
+        decoded.append((pid, arr))
+
     added = 0
     try:
-        for p in persons:
-            pid = (p.get("person_id") or "").strip()
-            vecs = p.get("vectors", [])
-            if not pid or not vecs:
-                continue
-            arr = np.array(vecs, dtype=np.float32)
-            if arr.ndim != 2 or not np.isfinite(arr).all():
-                continue
-            if arr.shape[1] > 2048:
-                continue
-            store.add_person_vectors(pid, l2norm(arr), mode=mode)
-            added += arr.shape[0]
+        if decoded and all(a.shape[1] == decoded[0][1].shape[1] for _, a in decoded):
+            # one SIMD pass over the combined buffer: single isfinite scan and
+            # a single l2norm, then slice back per person
+            counts = [a.shape[0] for _, a in decoded]
+            flat = decoded[0][1] if len(decoded) == 1 else np.concatenate([a for _, a in decoded])
+            rows_ok = np.isfinite(flat).all(axis=1)
+            flat = l2norm(flat)
+            splits = np.cumsum(counts)[:-1]
+            for (pid, _), chunk, ok in zip(decoded, np.split(flat, splits), np.split(rows_ok, splits)):
+                if not ok.all():
+                    continue  # same skip semantics as the per-person check
+                store.add_person_vectors(pid, chunk, mode=mode, rebuild=False)
+                added += chunk.shape[0]
+        else:
+            # mixed dimensions: validate per person so the store reports the
+            # mismatch as before
+            for pid, arr in decoded:
+                if not np.isfinite(arr).all():
+                    continue
+                store.add_person_vectors(pid, l2norm(arr), mode=mode, rebuild=False)
+                added += arr.shape[0]
+        store.rebuild_matrix()
         store.save()
     except ValueError as e:
+        store.rebuild_matrix()
         return jsonify({"status":"error","message":str(e)}), 400
 
     stats = store.list_people()
@@ -298,17 +688,27 @@ def refs_clear():
 
 @app.route("/api/refs/export", methods=["GET"])
 def refs_export():
-    out = {"dims": store.dims, "persons": []}
-    for s in store.list_people():
-        arr = store.persons.get(s.person_id, np.zeros((0, store.dims or 0), dtype=np.float32))
-        out["persons"].append({
-            "person_id": s.person_id,
-            "vectors": arr.tolist()
-        })
-    tmp_path = os.path.join(DATA_DIR, f"refs_export_{int(time.time())}.json")
-    with open(tmp_path, "w", encoding="utf-8") as f:
-        json.dump(out, f)
-    return send_file(tmp_path, mimetype="application/json", as_attachment=True, download_name="refs_export.json")
+    # Stream one person at a time straight from the ndarrays: no tolist()
+    # (a boxed Python float per element) and no temp file double-write.
+    def gen():
+        yield '{"dims": %s, "persons": [' % json.dumps(store.dims)
+        first = True
+        for pid, arr in list(store.persons.items()):
+            yield ('' if first else ',') + '{"person_id": %s, "vectors": ' % json.dumps(pid)
+            first = False
+            if orjson is not None:
+                yield orjson.dumps(np.ascontiguousarray(arr, dtype=np.float32),
+                                   option=orjson.OPT_SERIALIZE_NUMPY).decode()
+            else:
+                yield json.dumps(arr.tolist())
+            yield '}'
+        yield ']}'
+
+    return Response(
+        stream_with_context(gen()),
+        mimetype="application/json",
+        headers={"Content-Disposition": "attachment; filename=refs_export.json"},
+    )
 
 # --------- Sorting (Normal user) ----------
 @app.route("/api/sort", methods=["POST"])
@@ -333,7 +733,7 @@ def sort_api():
       }
     }
     """
-    payload = request.get_json(silent=True)
+    payload = _get_json(request)
     if not payload:
         return jsonify({"status":"error","message":"JSON body required"}), 400
 
@@ -348,90 +748,44 @@ def sort_api():
     policy = params.get("multi_face_policy", "copy_all")
     policy = policy if policy in ("copy_all", "best_single") else "copy_all"
 
-    # Build per-person stats once
-    people = store.list_people()
-    if not people:
-        return jsonify({"status":"error","message":"no references available on server"}), 400
+    # binary responses skip per-float JSON text entirely (~10-30x smaller
+    # score payloads); the UI keeps getting JSON
+    wants_msgpack = msgpack is not None and (
+        "application/msgpack" in (request.headers.get("Accept") or "")
+        or request.args.get("format") == "msgpack"
+    )
 
-    # cache normalized refs
-    refs_cache: Dict[str, np.ndarray] = {}
-    stats_map: Dict[str, Tuple[float,float]] = {}
-    for s in people:
-        arr = store.persons[s.person_id]
-        refs_cache[s.person_id] = arr  # already unit
-        stats_map[s.person_id] = (s.mu_pairs, s.sigma_pairs)
+    if not store.persons:
+        return jsonify({"status":"error","message":"no references available on server"}), 400
 
-    entries = []
-    n_faces = 0
+    # First pass: validate faces, stack valid query vectors into Q and remember
+    # which result slot each row fills.
+    per_image_results: List[List[dict]] = []
+    q_rows: List[np.ndarray] = []
+    q_slots: List[Tuple[int, int]] = []  # (image index, face index within image)
     for it in items:
         image_id = it.get("image_id", "")
         faces = it.get("faces", [])
         if not image_id or not isinstance(faces, list):
             continue
 
-        face_results = []
+        face_results: List[dict] = []
+        img_idx = len(per_image_results)
         for f in faces:
-            vec = np.array(f.get("vector", []), dtype=np.float32)
+            vec = _vector_from_face(f)
             face_id = f.get("face_id") or f"{image_id}#{len(face_results)}"
-            # basic checks
-            if vec.ndim != 1 or (store.dims and vec.shape[0] != store.dims):
+            if vec.ndim != 1 or (store.dims and vec.shape[0] != store.dims) or not np.isfinite(vec).all():
                 face_results.append({
                     "image_id": image_id, "face_id": face_id,
                     "decision": "invalid_vector", "score": None, "best_person": None
                 })
                 continue
-            if not np.isfinite(vec).all():
-                face_results.append({
-                    "image_id": image_id, "face_id": face_id,
-                    "decision": "invalid_vector", "score": None, "best_person": None
-                })
-                continue
-
-            # normalize
-            u = vec / (np.linalg.norm(vec) + 1e-12)
-
-            # score against all persons (max-of-refs)
-            best_person = None
-            best_score = -2.0
-            alts = []
-            for pid, rarr in refs_cache.items():
-                sc = best_score_against_person(u, rarr)
-                alts.append((pid, sc))
-                if sc > best_score:
-                    best_score = sc
-                    best_person = pid
-
-            # compute threshold for best_person
-            mu, sig = stats_map.get(best_person, (0.90, 0.05))
-            thr = compute_threshold(gthr, adaptive_on, mu, sig, adaptive_k)
-            above = best_score >= thr
-
-            face_results.append({
-                "image_id": image_id,
-                "face_id": face_id,
-                "best_person": best_person,
-                "score": float(best_score),
-                "threshold": float(thr),
-                "above": bool(above),
-                "alternatives": sorted(
-                    [{"person": p, "score": float(s)} for (p, s) in alts],
-                    key=lambda x: x["score"], reverse=True
-                )[:5],
-                "decision": "accept" if above else "reject"
-            })
-            n_faces += 1
-
-        # Apply multi-face policy if needed
-        if policy == "best_single":
-            accepted = [fr for fr in face_results if fr.get("decision") == "accept"]
-            if accepted:
-                top = max(accepted, key=lambda x: x["score"])
-                for fr in face_results:
-                    if fr is not top:
-                        fr["decision"] = "reject"
-
-        entries.extend(face_results)
+            q_slots.append((img_idx, len(face_results)))
+            face_results.append({"image_id": image_id, "face_id": face_id})  # filled below
+            q_rows.append(vec)
+        per_image_results.append(face_results)
 
+    n_faces = len(q_rows)
     summary = {
         "n_images": len(items),
         "n_faces": n_faces,
@@ -440,6 +794,102 @@ def sort_api():
         "adaptive_k": adaptive_k,
         "multi_face_policy": policy
     }
+    if n_faces:
+        Q = l2norm(np.asarray(q_rows, dtype=np.float32))   # (F, d), unit rows
+        # one GEMM scores all faces against all refs; with batching enabled,
+        # concurrent requests inside the window share a single larger GEMM
+        if SORT_BATCHER is not None:
+            scored = SORT_BATCHER.score(Q)
+        else:
+            pids, R, R_i8, owner, offsets, mu_arr, sigma_arr, index = store.matrix_snapshot()
+            scored = None if R is None else (
+                pids, mu_arr, sigma_arr, _person_scores(R, R_i8, owner, offsets, index, Q))
+        if scored is None:
+            return jsonify({"status":"error","message":"no references available on server"}), 400
+        pids, mu_arr, sigma_arr, per_person = scored       # per_person: (P, F) max-of-refs
+        np.clip(per_person, -1.0, 1.0, out=per_person)
+        best_idx = per_person.argmax(axis=0)               # (F,)
+        best_scores = per_person[best_idx, np.arange(n_faces)]
+        g = max(0, min(100, gthr)) / 100.0
+        if adaptive_on:
+            thr_arr = np.maximum(g, mu_arr[best_idx] - adaptive_k * sigma_arr[best_idx])
+        else:
+            thr_arr = np.full(n_faces, g, dtype=np.float32)
+        above_arr = best_scores >= thr_arr
+        decision_accept = above_arr
+        if policy == "best_single":
+            # vectorized per-image groupby: scatter-max the accepted scores
+            # into one slot per image, then keep only the first face hitting
+            # that max — same winner the old Python max() picked
+            img_ids = np.fromiter((s[0] for s in q_slots), dtype=np.int64, count=n_faces)
+            masked = np.where(above_arr, best_scores, -np.inf)
+            img_max = np.full(len(per_image_results), -np.inf)
+            np.maximum.at(img_max, img_ids, masked)
+            is_max = above_arr & (masked == img_max[img_ids])
+            first = np.full(len(per_image_results), n_faces, dtype=np.int64)
+            np.minimum.at(first, img_ids[is_max], np.nonzero(is_max)[0])
+            keep = np.zeros(n_faces, dtype=bool)
+            keep[first[first < n_faces]] = True
+            decision_accept = above_arr & keep
+        # top-5 alternatives: argpartition selects the candidates in O(P),
+        # then only those 5 are sorted per face
+        n_persons = per_person.shape[0]
+        k = min(5, n_persons)
+        if n_persons > k:
+            top_idx = np.argpartition(-per_person, kth=k - 1, axis=0)[:k]
+        else:
+            top_idx = np.tile(np.arange(n_persons)[:, None], (1, n_faces))
+        top_scores = np.take_along_axis(per_person, top_idx, axis=0)
+        alt_order = np.take_along_axis(top_idx, np.argsort(-top_scores, axis=0), axis=0)
+
+        if wants_msgpack:
+            # ship the score arrays as raw little-endian bytes plus an id/pid
+            # lookup instead of one JSON object per face
+            invalid = [fr for frs in per_image_results for fr in frs
+                       if fr.get("decision") == "invalid_vector"]
+            alt_scores = np.take_along_axis(per_person, alt_order, axis=0)
+            faces = {
+                "image_ids": [per_image_results[i][fi]["image_id"] for i, fi in q_slots],
+                "face_ids": [per_image_results[i][fi]["face_id"] for i, fi in q_slots],
+                "pids": pids,
+                "dtype": "f4",
+                "scores": np.ascontiguousarray(best_scores, dtype=np.float32).tobytes(),
+                "thresholds": np.ascontiguousarray(thr_arr, dtype=np.float32).tobytes(),
+                "accept": decision_accept.astype(np.uint8).tobytes(),
+                "best_person_idx": best_idx.astype(np.int32).tobytes(),
+                "alt_k": int(alt_order.shape[0]),
+                "alt_person_idx": np.ascontiguousarray(alt_order.T, dtype=np.int32).tobytes(),
+                "alt_scores": np.ascontiguousarray(alt_scores.T, dtype=np.float32).tobytes(),
+            }
+            body = {"status": "success", "summary": summary, "faces": faces, "invalid": invalid}
+            return Response(msgpack.packb(body, use_bin_type=True),
+                            mimetype="application/msgpack")
+
+        for j, (img_idx, face_idx) in enumerate(q_slots):
+            fr = per_image_results[img_idx][face_idx]
+            fr.update({
+                "best_person": pids[int(best_idx[j])],
+                "score": float(best_scores[j]),
+                "threshold": float(thr_arr[j]),
+                "above": bool(above_arr[j]),
+                "alternatives": [
+                    {"person": pids[int(pi)], "score": float(per_person[pi, j])}
+                    for pi in alt_order[:, j]
+                ],
+                "decision": "accept" if decision_accept[j] else "reject"
+            })
+
+    if wants_msgpack:
+        # no valid faces scored
+        invalid = [fr for frs in per_image_results for fr in frs
+                   if fr.get("decision") == "invalid_vector"]
+        body = {"status": "success", "summary": summary, "faces": None, "invalid": invalid}
+        return Response(msgpack.packb(body, use_bin_type=True),
+                        mimetype="application/msgpack")
+
+    entries = []
+    for face_results in per_image_results:
+        entries.extend(face_results)
 
     return jsonify({"status":"success", "summary": summary, "entries": entries})
 
@@ -447,6 +897,7 @@ def sort_api():
 # Static UI (served from /static)
 # -----------------------
 if __name__ == "__main__":
+    # local dev only — in production serve via gunicorn (see wsgi.py)
     print(f"Hybrid server listening on 0.0.0.0:{APP_PORT}")
     print(f"DATA_DIR={DATA_DIR} | ADMIN_TOKEN={'set' if ADMIN_TOKEN else 'not set'}", flush=True)
     app.run(host="0.0.0.0", port=APP_PORT)
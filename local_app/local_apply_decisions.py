@@ -3,22 +3,112 @@ import sys
 import json
 import argparse
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 def ensure_dir(p: Path):
     p.mkdir(parents=True, exist_ok=True)
 
+# FICLONE ioctl: share extents with the source (btrfs/XFS), instant and
+# space-free. Value from linux/fs.h.
+_FICLONE = 0x40049409
+
+def _clone_linux(src: Path, dst: Path):
+    import fcntl
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            # in-kernel copy: no userspace buffers, server-side on NFS 4.2
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = 0
+            while copied < size:
+                n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                if n == 0:
+                    raise OSError(f"copy_file_range stalled at {copied}/{size}")
+                copied += n
+    shutil.copystat(src, dst)
+
+def _clone_darwin(src: Path, dst: Path):
+    import ctypes, ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    if not hasattr(libc, "clonefile"):
+        raise OSError("clonefile unavailable")
+    if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+        raise OSError(ctypes.get_errno(), f"clonefile failed: {src}")
+    shutil.copystat(src, dst)
+
+def _fast_clone(src: Path, dst: Path):
+    """Copy src to dst using the cheapest path the filesystem offers:
+    reflink (APFS/btrfs/XFS) or copy_file_range where supported, falling
+    back to shutil.copy2 everywhere else (FAT/exFAT, SMB, Windows)."""
+    try:
+        if sys.platform.startswith("linux"):
+            _clone_linux(src, dst)
+            return
+        if sys.platform == "darwin":
+            _clone_darwin(src, dst)
+            return
+    except OSError:
+        try:
+            os.unlink(dst)  # drop any partial output before retrying
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
 def hard_link_or_copy(src: Path, dst: Path):
     try:
         os.link(src, dst)  # hardlink
     except Exception:
-        shutil.copy2(src, dst)
+        _fast_clone(src, dst)
 
 def symlink_or_copy(src: Path, dst: Path):
     try:
         dst.symlink_to(src)
     except Exception:
-        shutil.copy2(src, dst)
+        _fast_clone(src, dst)
+
+def apply_image_ops(src_path: Path, persons, mode: str, sorted_root: Path, made_dirs=None):
+    """
+    Apply one image's file operations sequentially (the move-then-copy chain
+    for extra persons must stay ordered). Returns (moved, copied, linked).
+    made_dirs caches already-created person folders so mkdir runs once per
+    person instead of once per file (set.add is atomic, safe across threads).
+    """
+    moved = copied = linked = 0
+    for i, person in enumerate(persons):
+        dst_dir = sorted_root / person
+        if made_dirs is None:
+            ensure_dir(dst_dir)
+        elif dst_dir not in made_dirs:
+            ensure_dir(dst_dir)
+            made_dirs.add(dst_dir)
+        dst_path = dst_dir / src_path.name
+
+        if mode == "move":
+            if len(persons) == 1 or i == 0:
+                try:
+                    os.rename(src_path, dst_path)
+                except OSError:
+                    # cross-filesystem: clone-or-copy, then drop the source
+                    _fast_clone(src_path, dst_path)
+                    os.unlink(src_path)
+                moved += 1
+                src_path = dst_path
+            else:
+                _fast_clone(src_path, dst_path)
+                copied += 1
+        elif mode == "copy":
+            _fast_clone(src_path, dst_path)
+            copied += 1
+        else:  # link
+            try:
+                os.link(src_path, dst_path)
+                linked += 1
+            except Exception:
+                symlink_or_copy(src_path, dst_path)
+                linked += 1
+    return moved, copied, linked
 
 def main():
     ap = argparse.ArgumentParser(description="Apply decisions.json locally (move/copy/link)")
@@ -50,14 +140,26 @@ def main():
     linked = 0
     skipped = 0
 
+    # one scandir pass over the inbox replaces a stat per image for the
+    # common "image_id is a bare filename" case; nested paths fall back
+    try:
+        inbox_index = {e.name: Path(e.path) for e in os.scandir(inbox_root) if e.is_file()}
+    except OSError:
+        inbox_index = {}
+
+    # plan first: (src, persons) per image, then run images in parallel —
+    # the syscalls (move/copy/link) release the GIL so threads overlap I/O
+    tasks = []
     for img_id, face_list in by_image.items():
-        src_path = Path(img_id)
-        if not src_path.is_file():
-            src_path = inbox_root / img_id
-        if not src_path.is_file():
-            print(f"[WARN] missing file: {img_id}")
-            skipped += 1
-            continue
+        src_path = inbox_index.get(img_id)
+        if src_path is None:
+            src_path = Path(img_id)
+            if not src_path.is_file():
+                src_path = inbox_root / img_id
+            if not src_path.is_file():
+                print(f"[WARN] missing file: {img_id}")
+                skipped += 1
+                continue
 
         accepted = [f for f in face_list if f.get("decision") == "accept" and f.get("best_person")]
         if not accepted:
@@ -76,29 +178,19 @@ def main():
                 seen.add(p)
                 persons.append(p)
 
-        for i, person in enumerate(persons):
-            dst_dir = sorted_root / person
-            ensure_dir(dst_dir)
-            dst_path = dst_dir / src_path.name
-
-            if args.mode == "move":
-                if len(persons) == 1 or i == 0:
-                    shutil.move(str(src_path), str(dst_path))
-                    moved += 1
-                    src_path = dst_path
-                else:
-                    shutil.copy2(str(src_path), str(dst_path))
-                    copied += 1
-            elif args.mode == "copy":
-                shutil.copy2(str(src_path), str(dst_path))
-                copied += 1
-            else:  # link
-                try:
-                    os.link(src_path, dst_path)
-                    linked += 1
-                except Exception:
-                    symlink_or_copy(src_path, dst_path)
-                    linked += 1
+        tasks.append((src_path, persons))
+
+    if tasks:
+        made_dirs = set()
+        workers = min(32, max(4, (os.cpu_count() or 4) * 4))
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futures = [ex.submit(apply_image_ops, src, persons, args.mode, sorted_root, made_dirs)
+                       for src, persons in tasks]
+            for fut in futures:
+                m, c, l = fut.result()
+                moved += m
+                copied += c
+                linked += l
 
     print(f"Done. moved={moved}, copied/linked={copied+linked}, skipped={skipped}")
     print(f"Output base: {sorted_root}")
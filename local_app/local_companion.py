@@ -1,13 +1,20 @@
-import os, json, pathlib, time, secrets, shutil
+import os, json, pathlib, time, secrets, threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import List
+import anyio
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import numpy as np
 
-from local_embed import build_app, get_face_vectors, scan_files, imread_utf8, IMG_EXTS
-from local_apply_decisions import ensure_dir, symlink_or_copy
+from local_embed import (build_app, get_face_vectors, embed_images, scan_files,
+                         iter_images, embed_refs_parallel, split_duplicates,
+                         EmbedCache,
+                         vector_to_b64, vectors_to_b64, dumps_bytes,
+                         quant_dtype, b64_dtype_tag)
+from local_apply_decisions import ensure_dir, symlink_or_copy, apply_image_ops
 
 HOST = "127.0.0.1"
 PORT = 8765
@@ -27,6 +34,49 @@ def _get_or_create_token() -> str:
 
 COMPANION_TOKEN = _get_or_create_token()
 
+# FaceAnalysis.prepare loads ~300MB of ONNX weights; reuse sessions across
+# requests instead of paying that per call. InsightFace sessions aren't
+# thread-safe, so inference is serialized behind one lock.
+_INFER_LOCK = threading.Lock()
+
+@lru_cache(maxsize=4)
+def _get_app(det_size: int, provider=None):
+    return build_app(det_size=(det_size, det_size), provider=provider)
+
+async def _post_json(url: str, headers: dict, body: dict, timeout: float):
+    """POST without blocking the event loop: httpx when available, else
+    requests offloaded to a worker thread. Bodies are pre-encoded with
+    orjson (numpy-aware, C-speed) when installed."""
+    try:
+        import orjson
+        data = orjson.dumps(body, option=orjson.OPT_SERIALIZE_NUMPY)
+    except ImportError:
+        data = json.dumps(body).encode("utf-8")
+    headers = {**headers, "Content-Type": "application/json"}
+    try:
+        import httpx
+    except ImportError:
+        import requests
+        return await anyio.to_thread.run_sync(
+            lambda: requests.post(url, headers=headers, data=data, timeout=timeout))
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        return await client.post(url, headers=headers, content=data)
+
+def _proxy_envelope(message: str, body: bytes):
+    """Wrap the upstream JSON bytes in the companion envelope without ever
+    parsing them — for big /api/sort replies the old r.json() round-trip
+    double-parsed and re-serialized megabytes on this box."""
+    head = ('{"status": "ok", "message": %s, "server_response": '
+            % json.dumps(message)).encode("utf-8")
+
+    def gen():
+        yield head
+        yield body
+        yield b"}"
+
+    return StreamingResponse(gen(), media_type="application/json",
+                             headers={"X-Upstream": "server"})
+
 app = FastAPI(title="Photo Sorter Local Companion")
 app.add_middleware(
     CORSMiddleware,
@@ -56,51 +106,82 @@ def status():
     }
 
 @app.post("/compute-refs")
-def compute_refs(payload: dict):
+async def compute_refs(payload: dict):
     refs_path = payload.get("refs_path", "")
     mode = payload.get("mode", "merge")
     det_size = int(payload.get("det_size", 640))
+    # f16 by default: uploads halve with no measurable accuracy cost
+    dtype = quant_dtype(payload.get("quant"), default=np.float16)
     root = pathlib.Path(refs_path)
     if not root.exists():
         raise HTTPException(400, f"Refs path not found: {root}")
 
-    face_app = build_app(det_size=(det_size, det_size))
-
-    persons = []
-    for person_dir in [p for p in root.iterdir() if p.is_dir()]:
-        pid = person_dir.name
-        vectors: List[List[float]] = []
-        files = scan_files(person_dir)
-        for fp in files:
-            img = imread_utf8(str(fp))
-            if img is None:
-                continue
-            vecs = get_face_vectors(face_app, img, max_faces=None)
-            for v in vecs:
-                vectors.append(v.tolist())
-        if vectors:
-            persons.append({"person_id": pid, "vectors": vectors})
+    # inference is CPU-bound and serialized behind _INFER_LOCK — run it in a
+    # worker thread so the event loop keeps serving /status etc. meanwhile
+    def _embed():
+        parallel = payload.get("parallel")
+        if parallel is not None:
+            # N spawned workers, each with its own model — no shared ONNX
+            # session, so the inference lock doesn't apply here
+            person_dirs = [p for p in root.iterdir() if p.is_dir()]
+            results = embed_refs_parallel(person_dirs, parallel, det_size=det_size,
+                                          provider=payload.get("provider"))
+        else:
+            face_app = _get_app(det_size, payload.get("provider"))
+            cache = None if payload.get("no_cache") else EmbedCache()
+            results = []
+            with _INFER_LOCK:
+                for person_dir in [p for p in root.iterdir() if p.is_dir()]:
+                    vectors: List[np.ndarray] = []
+                    todo = []
+                    for fp in scan_files(person_dir):
+                        hit = cache.get(fp, det_size) if cache is not None else None
+                        if hit is None:
+                            todo.append(fp)
+                        else:
+                            vectors.extend(hit)
+                    for fp, img in iter_images(todo, det_size=det_size):
+                        if img is None:
+                            continue
+                        vecs = get_face_vectors(face_app, img, max_faces=None)
+                        if cache is not None:
+                            cache.put(fp, det_size, vecs)
+                        vectors.extend(vecs)
+                    results.append((person_dir.name, vectors))
+            if cache is not None:
+                cache.close()
+        persons = []
+        for pid, vectors in results:
+            if vectors:
+                # base64 bytes instead of float lists: smaller upload, and the
+                # server decodes it with one np.frombuffer
+                b64, dims, tag = vectors_to_b64(vectors, dtype=dtype)
+                persons.append({"person_id": pid, "vectors_b64": b64, "dims": dims, "dtype": tag})
+        return persons
+
+    persons = await anyio.to_thread.run_sync(_embed)
 
     out = {"persons": persons, "mode": mode}
     if not persons:
         return {"status": "ok", "message": "no faces found", "payload": out}
 
     if SERVER_BASE:
-        import requests
         headers = {"Content-Type": "application/json"}
         if ADMIN_TOKEN:
             headers["X-Admin-Token"] = ADMIN_TOKEN
-        r = requests.post(f"{SERVER_BASE}/api/refs/register-batch", headers=headers, json=out, timeout=120)
+        r = await _post_json(f"{SERVER_BASE}/api/refs/register-batch", headers, out, timeout=120)
         if r.status_code != 200:
             raise HTTPException(502, f"Server register failed: {r.text}")
-        return {"status": "ok", "message": "registered via server", "server_response": r.json()}
+        return _proxy_envelope("registered via server", r.content)
 
     return {"status": "ok", "message": "computed refs locally", "payload": out}
 
 @app.post("/compute-inbox")
-def compute_inbox(payload: dict):
+async def compute_inbox(payload: dict):
     inbox_path = payload.get("inbox_path", "")
     det_size = int(payload.get("det_size", 640))
+    dtype = quant_dtype(payload.get("quant"), default=np.float16)
+    tag = b64_dtype_tag(dtype)
 
     thr = int(payload.get("global_threshold_pct", 32))
     adaptive_on = bool(payload.get("adaptive_on", True))
@@ -111,25 +192,55 @@ def compute_inbox(payload: dict):
     if not root.exists():
         raise HTTPException(400, f"Inbox path not found: {root}")
 
-    face_app = build_app(det_size=(det_size, det_size))
-
-    items = []
-    files = []
-    for ext in IMG_EXTS:
-        files.extend(root.rglob(f"*{ext}"))
-    files = sorted(set(files))
-    for fp in files:
-        img = imread_utf8(str(fp))
-        if img is None:
-            continue
-        vecs = get_face_vectors(face_app, img, max_faces=None)
-        faces = [{"face_id": f"{fp.name}#{i}", "vector": v.tolist()} for i, v in enumerate(vecs)]
-        items.append({"image_id": str(fp), "faces": faces})
+    def _embed():
+        face_app = _get_app(det_size, payload.get("provider"))
+        cache = None if payload.get("no_cache") else EmbedCache()
+        files = scan_files(root)
+        cached = {}
+        if cache is not None:
+            remaining = []
+            for fp in files:
+                hit = cache.get(fp, det_size)
+                if hit is None:
+                    remaining.append(fp)
+                else:
+                    cached[fp] = hit
+            files = remaining
+        # exact duplicates (device syncs, re-downloads) skip detection and
+        # reuse the representative's vectors
+        files, dup_of = split_duplicates(files)
+        pairs = ((fp, img) for fp, img in iter_images(files, det_size=det_size) if img is not None)
+        with _INFER_LOCK:
+            vec_map = embed_images(face_app, pairs, max_faces=None)
+        for fp, src in dup_of.items():
+            if src in vec_map:
+                vec_map[fp] = vec_map[src]
+        if cache is not None:
+            for fp, vecs in vec_map.items():
+                cache.put(fp, det_size, vecs)
+            cache.close()
+            for fp, hit in cached.items():
+                vec_map.setdefault(fp, hit)
+        items = []
+        for fp, vecs in vec_map.items():
+            faces = [{"face_id": f"{fp.name}#{i}", "vector_b64": vector_to_b64(v, dtype=dtype), "dtype": tag}
+                     for i, v in enumerate(vecs)]
+            items.append({"image_id": str(fp), "faces": faces})
+        return items
+
+    items = await anyio.to_thread.run_sync(_embed)
 
     if not SERVER_BASE:
-        return {"status": "ok", "payload": {"items": items}}
+        # stream item by item instead of serializing one giant document
+        def gen():
+            yield b'{"status": "ok", "payload": {"items": ['
+            for i, item in enumerate(items):
+                if i:
+                    yield b", "
+                yield dumps_bytes(item)
+            yield b"]}}"
+        return StreamingResponse(gen(), media_type="application/json")
 
-    import requests
     body = {
         "items": items,
         "params": {
@@ -139,13 +250,13 @@ def compute_inbox(payload: dict):
             "multi_face_policy": policy if policy in ("copy_all", "best_single") else "copy_all",
         }
     }
-    r = requests.post(f"{SERVER_BASE}/api/sort", headers={"Content-Type": "application/json"}, json=body, timeout=600)
+    r = await _post_json(f"{SERVER_BASE}/api/sort", {"Content-Type": "application/json"}, body, timeout=600)
     if r.status_code != 200:
         raise HTTPException(502, f"Server sort failed: {r.text}")
-    return {"status": "ok", "message": "sorted via server", "server_response": r.json()}
+    return _proxy_envelope("sorted via server", r.content)
 
 @app.post("/apply-decisions")
-def apply_decisions(payload: dict):
+async def apply_decisions(payload: dict):
     dec = payload.get("decisions_json", {})
     inbox = pathlib.Path(payload.get("inbox_path", ""))
     sorted_out = pathlib.Path(payload.get("sorted_path", ""))
@@ -153,7 +264,10 @@ def apply_decisions(payload: dict):
     if not inbox.exists():
         raise HTTPException(400, f"Inbox path not found: {inbox}")
     ensure_dir(sorted_out)
+    # the move/copy loop is pure disk I/O — keep it off the event loop
+    return await anyio.to_thread.run_sync(lambda: _apply_decisions_sync(dec, inbox, sorted_out, mode))
 
+def _apply_decisions_sync(dec: dict, inbox: pathlib.Path, sorted_out: pathlib.Path, mode: str):
     entries = dec.get("entries", [])
     policy = (dec.get("params", {}) or {}).get("multi_face_policy", "copy_all")
 
@@ -165,6 +279,9 @@ def apply_decisions(payload: dict):
 
     moved = copied = linked = skipped = 0
 
+    # plan first, then run images in parallel: per-image ops stay sequential
+    # (the move-then-copy chain), but independent images overlap disk I/O
+    tasks = []
     for img_id, face_list in by_image.items():
         src = pathlib.Path(img_id)
         if not src.is_file():
@@ -188,24 +305,17 @@ def apply_decisions(payload: dict):
             if p and p not in seen:
                 seen.add(p); persons.append(p)
 
-        for i, person in enumerate(persons):
-            dst_dir = sorted_out / person
-            ensure_dir(dst_dir)
-            dst = dst_dir / src.name
-
-            if mode == "move":
-                if len(persons) == 1 or i == 0:
-                    shutil.move(str(src), str(dst)); moved += 1
-                    src = dst
-                else:
-                    shutil.copy2(str(src), str(dst)); copied += 1
-            elif args.mode == "copy":
-                shutil.copy2(str(src), str(dst)); copied += 1
-            else:  # link
-                try:
-                    os.link(src, dst); linked += 1
-                except Exception:
-                    symlink_or_copy(src, dst); linked += 1
+        tasks.append((src, persons))
+
+    if tasks:
+        made_dirs = set()
+        workers = min(32, max(4, (os.cpu_count() or 4) * 4))
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futures = [ex.submit(apply_image_ops, src, persons, mode, sorted_out, made_dirs)
+                       for src, persons in tasks]
+            for fut in futures:
+                m, c, l = fut.result()
+                moved += m; copied += c; linked += l
 
     return {"status": "ok", "moved": moved, "copied_or_linked": copied+linked, "skipped": skipped, "sorted_root": str(sorted_out)}
 
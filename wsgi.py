@@ -0,0 +1,15 @@
+"""
+WSGI entrypoint for production servers.
+
+The built-in dev server (python app.py) handles one request at a time;
+serve with gunicorn to parallelize JSON parsing and scoring across
+cores, e.g.:
+
+    gunicorn -w $(nproc) -k gthread --threads 4 -b 0.0.0.0:$PORT wsgi:application
+
+With SORT_BATCH_WINDOW_MS batching enabled, prefer a single worker with
+many threads (and BLAS threads = nproc) so concurrent sort requests land
+in the same process and share one GEMM; without batching, use one worker
+per core and pin BLAS to a single thread.
+"""
+from app import app as application  # noqa: F401